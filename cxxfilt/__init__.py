@@ -1,12 +1,34 @@
 import abc
 import ctypes
 import ctypes.util
+import functools
+import os
+import re
+import struct
+import subprocess
+import sys
+import threading
 
-from typing import Sequence, Union
+from typing import Iterable, List, Optional, Union
 
 from cxxfilt.version import __version__  # noqa
 
 
+# default number of demangled names remembered by each Demangler
+_CACHE_SIZE = 4096
+
+# Names longer than this are returned as is: __cxa_demangle can spend
+# seconds and gigabytes of memory on long (possibly crafted) names.
+MAX_MANGLED_LEN = 8192
+
+# Output buffers that grew beyond this are freed rather than kept, so that
+# one huge name does not pin its allocation for the lifetime of a thread.
+_KEPT_BUFFER_SIZE = 1 << 16
+
+# saves a module attribute lookup per demangled name
+_string_at = ctypes.string_at
+
+
 class Error(Exception):
     pass
 
@@ -31,72 +53,257 @@ class InvalidName(Error):
         return repr(self.mangled_name)
 
 
-class CharP(ctypes.c_char_p):
-    pass
+# errors for the non-zero status codes of __cxa_demangle
+_STATUS_ERRORS = {
+    -1: lambda mangled_name: InternalError('A memory allocation failure occurred'),
+    -2: InvalidName,
+    -3: lambda mangled_name: InternalError('One of the arguments is invalid'),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _ldconfig_cache() -> bytes:
+    '''Output of `ldconfig -p`, run at most once per process.'''
+    if not sys.platform.startswith('linux'):
+        return b''
+    try:
+        return subprocess.run(
+            ['/sbin/ldconfig', '-p'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env={'LC_ALL': 'C', 'LANG': 'C'},
+        ).stdout
+    except OSError:
+        return b''
+
+
+def _find_library(name: str) -> Optional[str]:
+    # ctypes.util.find_library runs ldconfig for every name it looks up;
+    # search a single shared run the same way before falling back to it
+    ldconfig_cache = _ldconfig_cache()
+    if not ldconfig_cache:
+        return ctypes.util.find_library(name)
+
+    # same lookup as the private ctypes.util._findSoname_ldconfig
+    # (CPython Lib/ctypes/util.py); keep the two in sync
+    if struct.calcsize('l') == 4:
+        machine = os.uname().machine + '-32'
+    else:
+        machine = os.uname().machine + '-64'
+    abi_type = {
+        'x86_64-64': 'libc6,x86-64',
+        'ppc64-64': 'libc6,64bit',
+        'sparc64-64': 'libc6,64bit',
+        's390x-64': 'libc6,64bit',
+        'ia64-64': 'libc6,IA-64',
+    }.get(machine, 'libc6')
+    regex = r'\s+(lib%s\.[^\s]+)\s+\(%s' % (re.escape(name), abi_type)
+    match = re.search(os.fsencode(regex), ldconfig_cache)
+    if match:
+        return os.fsdecode(match.group(1))
+    return ctypes.util.find_library(name)
 
 
 def find_any_library(*choices: str) -> str:
     for choice in choices:
-        lib = ctypes.util.find_library(choice)
+        lib = _find_library(choice)
         if lib is not None:
             return lib
     raise LibraryNotFound('Cannot find any of libraries: {}'.format(choices))
 
 
+@functools.lru_cache(maxsize=None)
+def _load_library(name: str) -> ctypes.CDLL:
+    # share one handle (and its cached function objects) per library
+    return ctypes.CDLL(name)
+
+
+class _OutputBuffer:
+    '''malloc()ed buffer handed back to __cxa_demangle on every call,
+    which reuses it, or realloc()s it when it is too small.'''
+
+    __slots__ = ('_free', 'pointer', 'length', 'length_ref')
+
+    def __init__(self, free) -> None:
+        self._free = free
+        # NULL until the first successful call hands us a buffer
+        self.pointer = ctypes.c_void_p()
+        self.length = ctypes.c_size_t()
+        self.length_ref = ctypes.byref(self.length)
+
+    def __del__(self) -> None:
+        self._free(self.pointer)
+
+
+class _ThreadState(threading.local):
+    '''Per-thread scratch space passed to __cxa_demangle.'''
+
+    def __init__(self, free) -> None:
+        self.status = ctypes.c_int()
+        self.status_ref = ctypes.byref(self.status)
+        self.buffer = _OutputBuffer(free)
+
+
+def _demangleb_uncached(
+    cxa_demangle, free, state: _ThreadState, mangled_name: bytes
+) -> bytes:
+    buffer = state.buffer
+    retval = cxa_demangle(
+        mangled_name, buffer.pointer, buffer.length_ref, state.status_ref
+    )
+
+    status = state.status.value
+    if status == 0:
+        demangled = _string_at(retval)
+        # the buffer may have been realloc()ed; keep the new one
+        if len(demangled) < _KEPT_BUFFER_SIZE:
+            buffer.pointer.value = retval
+        else:
+            buffer.pointer.value = None
+            free(retval)
+        return demangled
+
+    error = _STATUS_ERRORS.get(status)
+    if error is None:
+        raise InternalError('Unknown status code: {}'.format(status))
+    raise error(mangled_name)
+
+
 class BaseDemangler(abc.ABC):
+    __slots__ = ()
+
     @abc.abstractmethod
     def demangleb(self, mangled_name: bytes, external_only: bool = True) -> bytes:
         raise NotImplementedError
 
     def demangle(self, mangled_name: str, external_only: bool = True) -> str:
-        return self.demangleb(
-            mangled_name.encode(), external_only=external_only
-        ).decode()
+        return self.demangleb(mangled_name.encode(), external_only).decode()
+
+    def demangleb_many(
+        self, mangled_names: Iterable[bytes], external_only: bool = True
+    ) -> List[bytes]:
+        demangleb = self.demangleb
+        return [demangleb(name, external_only) for name in mangled_names]
+
+    def demangle_many(
+        self, mangled_names: Iterable[str], external_only: bool = True
+    ) -> List[str]:
+        demangle = self.demangle
+        return [demangle(name, external_only) for name in mangled_names]
+
+    def cache_clear(self) -> None:
+        pass
 
 
 class Demangler(BaseDemangler):
-    def __init__(self, libc_name: str, libcxx_name: str) -> None:
+    __slots__ = (
+        '_libc_name',
+        '_free',
+        '_libcxx_name',
+        '_cxa_demangle',
+        '_max_mangled_len',
+        '_state',
+        '_demangleb_cached',
+        '__weakref__',
+    )
+
+    def __init__(
+        self,
+        libc_name: str,
+        libcxx_name: str,
+        cache_size: Optional[int] = _CACHE_SIZE,
+        max_mangled_len: Optional[int] = None,
+    ) -> None:
         assert isinstance(libc_name, str), libc_name
         assert isinstance(libcxx_name, str), libcxx_name
 
         self._libc_name = libc_name
-        libc = ctypes.CDLL(libc_name)
+        libc = _load_library(libc_name)
         self._free = libc.free
         self._free.argtypes = [ctypes.c_void_p]
 
         self._libcxx_name = libcxx_name
-        libcxx = ctypes.CDLL(libcxx_name)
+        libcxx = _load_library(libcxx_name)
         # use getattr to workaround with python's own name mangling
         self._cxa_demangle = getattr(libcxx, '__cxa_demangle')
-        self._cxa_demangle.restype = CharP
+        self._cxa_demangle.argtypes = [
+            ctypes.c_char_p,
+            ctypes.c_void_p,
+            ctypes.POINTER(ctypes.c_size_t),
+            ctypes.POINTER(ctypes.c_int),
+        ]
+        # a plain address: the result is copied out with string_at and the
+        # address is kept to be passed back in as the output buffer
+        self._cxa_demangle.restype = ctypes.c_void_p
+
+        # None follows the module-level MAX_MANGLED_LEN
+        self._max_mangled_len = max_mangled_len
+
+        # __cxa_demangle may run concurrently with the GIL released,
+        # so the reused status and buffer must not be shared between threads
+        self._state = _ThreadState(self._free)
+
+        # symbol streams repeat the same names over and over; remember
+        # recent results to skip the foreign call entirely.
+        # The cached function must not refer back to self: the reference
+        # cycle would keep the C buffers alive until the next gc run.
+        self._demangleb_cached = functools.lru_cache(maxsize=cache_size)(
+            functools.partial(
+                _demangleb_uncached, self._cxa_demangle, self._free, self._state
+            )
+        )
 
     def __repr__(self) -> str:
         return f'<{self.__class__.__name__} libc={self._libc_name!r} libcxx={self._libcxx_name!r}>'
 
+    def _get_max_mangled_len(self) -> int:
+        # None follows the module-level MAX_MANGLED_LEN
+        if self._max_mangled_len is None:
+            return MAX_MANGLED_LEN
+        return self._max_mangled_len
+
+    def demangle(self, mangled_name: str, external_only: bool = True) -> str:
+        # skip the encode/decode round trip for names returned as is,
+        # unless a subclass has overridden demangleb()
+        if (
+            external_only
+            and not mangled_name.startswith('_Z')
+            and type(self).demangleb is Demangler.demangleb
+        ):
+            return mangled_name
+
+        return self.demangleb(mangled_name.encode(), external_only).decode()
+
     def demangleb(self, mangled_name: bytes, external_only: bool = True) -> bytes:
         # Wikipedia: All *external* mangled symbols begin with _Z
         if external_only and not mangled_name.startswith(b'_Z'):
             return mangled_name
 
-        mangled_name_p = ctypes.c_char_p(mangled_name)
-        status = ctypes.c_int()
-        retval = self._cxa_demangle(mangled_name_p, None, None, ctypes.pointer(status))
-
-        try:
-            demangled = retval.value
-        finally:
-            self._free(retval)
-
-        if status.value == 0:
-            return demangled
-        elif status.value == -1:
-            raise InternalError('A memory allocation failiure occurred')
-        elif status.value == -2:
-            raise InvalidName(mangled_name)
-        elif status.value == -3:
-            raise InternalError('One of the arguments is invalid')
-        else:
-            raise InternalError('Unkwon status code: {}'.format(status.value))
+        if len(mangled_name) > self._get_max_mangled_len():
+            return mangled_name
+
+        return self._demangleb_cached(mangled_name)
+
+    def demangleb_many(
+        self, mangled_names: Iterable[bytes], external_only: bool = True
+    ) -> List[bytes]:
+        # only inline demangleb() when a subclass has not overridden it
+        if not external_only or type(self).demangleb is not Demangler.demangleb:
+            return super().demangleb_many(mangled_names, external_only)
+
+        # demangleb() inlined into the loop: saves a Python call per name
+        max_mangled_len = self._get_max_mangled_len()
+        demangle = self._demangleb_cached
+        return [
+            name
+            if not name.startswith(b'_Z') or len(name) > max_mangled_len
+            else demangle(name)
+            for name in mangled_names
+        ]
+
+    def cache_clear(self) -> None:
+        self._demangleb_cached.cache_clear()
 
 
 class DeferedErrorDemangler(BaseDemangler):
@@ -116,18 +323,68 @@ def _get_default_demangler() -> BaseDemangler:
     return Demangler(libc, libcxx)
 
 
-default_demangler: BaseDemangler = _get_default_demangler()
+# Created on first use: finding and loading the libraries may run external
+# programs (see ctypes.util.find_library), which should not slow down import.
+default_demangler: BaseDemangler
+
+
+def _init_default_demangler() -> BaseDemangler:
+    global default_demangler
+    default_demangler = _get_default_demangler()
+    # A module __getattr__ stops CPython from specializing every
+    # `cxxfilt.<name>` lookup; it is not needed once the global exists.
+    globals().pop('__getattr__', None)
+    return default_demangler
+
+
+def _default() -> BaseDemangler:
+    try:
+        return default_demangler
+    except NameError:
+        return _init_default_demangler()
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name: str):
+        if name == 'default_demangler':
+            return _init_default_demangler()
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+else:
+    # no module __getattr__ before python 3.7 (PEP 562)
+    _init_default_demangler()
 
 
 def demangle(mangled_name: str, external_only: bool = True) -> str:
-    return default_demangler.demangle(
-        mangled_name=mangled_name,
-        external_only=external_only,
-    )
+    # _default() inlined: this is the hot path
+    try:
+        demangler = default_demangler
+    except NameError:
+        demangler = _init_default_demangler()
+    return demangler.demangle(mangled_name, external_only)
 
 
 def demangleb(mangled_name: bytes, external_only: bool = True) -> bytes:
-    return default_demangler.demangleb(
-        mangled_name=mangled_name,
-        external_only=external_only,
-    )
+    # _default() inlined: this is the hot path
+    try:
+        demangler = default_demangler
+    except NameError:
+        demangler = _init_default_demangler()
+    return demangler.demangleb(mangled_name, external_only)
+
+
+def demangle_many(mangled_names: Iterable[str], external_only: bool = True) -> List[str]:
+    return _default().demangle_many(mangled_names, external_only)
+
+
+def demangleb_many(
+    mangled_names: Iterable[bytes], external_only: bool = True
+) -> List[bytes]:
+    return _default().demangleb_many(mangled_names, external_only)
+
+
+def cache_clear() -> None:
+    try:
+        demangler = default_demangler
+    except NameError:
+        return  # nothing demangled yet
+    demangler.cache_clear()
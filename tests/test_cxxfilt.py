@@ -1,10 +1,24 @@
 from __future__ import unicode_literals
 
+import gc
+import subprocess
+import sys
+import threading
+import weakref
+
 import pytest
 
 import cxxfilt
 
 
+def make_demangler(cls=cxxfilt.Demangler, **kwargs):
+    return cls(
+        cxxfilt.find_any_library('c'),
+        cxxfilt.find_any_library('stdc++', 'c++'),
+        **kwargs
+    )
+
+
 def test_not_mangled_name():
     assert cxxfilt.demangle('main') == 'main'
 
@@ -13,6 +27,25 @@ def test_not_mangled_nameb():
     assert cxxfilt.demangleb(b'main') == b'main'
 
 
+def test_reject_wrong_type():
+    with pytest.raises(TypeError):
+        cxxfilt.demangle(b'_ZN3foo3barE')
+
+    with pytest.raises(TypeError):
+        cxxfilt.demangle(b'main')
+
+
+def test_reject_wrong_typeb():
+    with pytest.raises(TypeError):
+        cxxfilt.demangleb('_ZN3foo3barE')
+
+    with pytest.raises(TypeError):
+        cxxfilt.demangleb('main')
+
+    with pytest.raises(TypeError):
+        cxxfilt.demangleb_many(['_ZN3foo3barE'])
+
+
 def test_reject_invalid_name():
     with pytest.raises(cxxfilt.InvalidName):
         cxxfilt.demangle('_ZQQ')
@@ -23,6 +56,37 @@ def test_reject_invalid_nameb():
         cxxfilt.demangleb(b'_ZQQ')
 
 
+@pytest.mark.parametrize(
+    'input',
+    ['std::bad_exception', 'main()', 'foo bar', 'std::vector<int>'],
+)
+def test_reject_demangled_name(input):
+    with pytest.raises(cxxfilt.InvalidName):
+        cxxfilt.demangle(input, external_only=False)
+
+    assert cxxfilt.demangle(input) == input
+
+
+@pytest.mark.parametrize(
+    ['input', 'output'],
+    [
+        # source names are copied byte for byte
+        (b'_Z3f()v', b'f()()'),
+        (b'_ZN3a b1cE', b'a b::c'),
+        (b'_ZN3a()1bE', b'a()::b'),
+        (b'_Z3a@bv', b'a@b()'),
+    ],
+)
+def test_external_only_same_result(input, output):
+    assert cxxfilt.demangleb(input) == output
+    assert cxxfilt.demangleb(input, external_only=False) == output
+
+
+@pytest.mark.parametrize(['input', 'output'], [(b'3a b', b'a b'), (b'3a:b', b'a:b')])
+def test_internal_source_name(input, output):
+    assert cxxfilt.demangleb(input, external_only=False) == output
+
+
 def test_demangle():
     assert cxxfilt.demangle('_ZNSt22condition_variable_anyD2Ev') in {
         'std::condition_variable_any::~condition_variable_any()',
@@ -57,15 +121,175 @@ def test_demangle_parametrize(input, external_only, valid_outputs):
     assert cxxfilt.demangle(input, external_only=external_only) in valid_outputs
 
 
+def test_max_mangled_len():
+    mangled = '_ZN' + '3foo' * 3000 + '3barE'
+    assert len(mangled) > cxxfilt.MAX_MANGLED_LEN
+    assert cxxfilt.demangle(mangled) == mangled
+    assert cxxfilt.demangle(mangled, external_only=False) == mangled
+
+
+def test_max_mangled_len_argument():
+    demangler = make_demangler(max_mangled_len=12)
+    assert demangler.demangle('_ZN3foo3barE') == 'foo::bar'
+    assert demangler.demangle('_ZN3foo3bazEv') == '_ZN3foo3bazEv'
+
+
+def test_demangle_many():
+    assert cxxfilt.demangle_many(['main', '_ZN3foo3barE']) == ['main', 'foo::bar']
+    assert cxxfilt.demangle_many(iter(['St13bad_exception']), external_only=False) == [
+        'std::bad_exception'
+    ]
+    assert cxxfilt.demangle_many([]) == []
+
+
+def test_demangleb_many():
+    assert cxxfilt.demangleb_many([b'main', b'_ZN3foo3barE']) == [b'main', b'foo::bar']
+
+    with pytest.raises(cxxfilt.InvalidName):
+        cxxfilt.demangleb_many([b'main', b'_ZQQ'])
+
+    long_name = b'_ZN' + b'3foo' * 3000 + b'3barE'
+    assert cxxfilt.demangleb_many([long_name]) == [long_name]
+    assert cxxfilt.demangleb_many([b'St13bad_exception'], external_only=False) == [
+        b'std::bad_exception'
+    ]
+
+
+def test_demangleb_many_subclass():
+    class UpperDemangler(cxxfilt.Demangler):
+        def demangleb(self, mangled_name, external_only=True):
+            return super().demangleb(mangled_name, external_only).upper()
+
+    demangler = make_demangler(cls=UpperDemangler)
+    assert demangler.demangleb_many([b'main', b'_ZN3foo3barE']) == [
+        b'MAIN',
+        b'FOO::BAR',
+    ]
+    assert demangler.demangle('main') == 'MAIN'
+    assert demangler.demangle_many(['main', '_ZN3foo3barE']) == ['MAIN', 'FOO::BAR']
+
+
+def test_cache():
+    mangled = b'_ZNSt22condition_variable_anyD2Ev'
+    assert cxxfilt.demangleb(mangled) is cxxfilt.demangleb(mangled)
+
+    cxxfilt.cache_clear()
+    assert cxxfilt.demangleb(mangled) in {
+        b'std::condition_variable_any::~condition_variable_any()',
+        b'std::condition_variable_any::~condition_variable_any(void)',
+    }
+
+
+@pytest.mark.parametrize('cache_size', [0, 1, None])
+def test_cache_size(cache_size):
+    demangler = make_demangler(cache_size=cache_size)
+
+    for _ in range(2):
+        assert demangler.demangle('_ZN1a1bE') == 'a::b'
+        assert demangler.demangle('_ZN1a1cE') == 'a::c'
+
+
+def test_buffer_reuse():
+    demangler = make_demangler()
+    long_name = '_ZN' + '3foo' * 200 + '3barE'
+    long_demangled = 'foo::' * 200 + 'bar'
+
+    for _ in range(2):
+        assert demangler.demangle('_ZN3foo3barE') == 'foo::bar'
+        with pytest.raises(cxxfilt.InvalidName):
+            demangler.demangle('_ZQQ')
+        assert demangler.demangle(long_name) == long_demangled
+        assert demangler.demangle('_ZN1a1bE') == 'a::b'
+        demangler.cache_clear()
+
+
+def test_buffer_release(monkeypatch):
+    monkeypatch.setattr(cxxfilt, '_KEPT_BUFFER_SIZE', 16)
+    demangler = make_demangler()
+
+    assert demangler.demangle('_ZN1a1bE') == 'a::b'
+    assert demangler._state.buffer.pointer.value is not None
+
+    assert demangler.demangle('_ZN3foo3foo3foo3barE') == 'foo::foo::foo::bar'
+    assert demangler._state.buffer.pointer.value is None
+
+    assert demangler.demangle('_ZN1a1cE') == 'a::c'
+    assert demangler._state.buffer.pointer.value is not None
+
+
+def test_no_reference_cycle():
+    demangler = make_demangler()
+    assert demangler.demangle('_ZN1a1bE') == 'a::b'
+    ref = weakref.ref(demangler)
+
+    gc.disable()
+    try:
+        del demangler
+        assert ref() is None
+    finally:
+        gc.enable()
+
+
+def test_threads():
+    demangler = make_demangler()
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(2000):
+                # distinct names so that every call misses the cache
+                name = 'f{}x{}'.format(n, i) * (i % 7 + 1)
+                mangled = '_ZN{}{}E'.format(len(name), name)
+                assert demangler.demangle(mangled) == name
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+
 def test_find_any_library():
     with pytest.raises(cxxfilt.LibraryNotFound):
         cxxfilt.find_any_library()
 
 
+def test_find_any_library_without_ldconfig(monkeypatch):
+    # e.g. windows: no ldconfig and no os.uname
+    monkeypatch.setattr(sys, 'platform', 'win32')
+    monkeypatch.delattr('os.uname', raising=False)
+    monkeypatch.setattr('ctypes.util.find_library', lambda name: None)
+    cxxfilt._ldconfig_cache.cache_clear()
+    try:
+        with pytest.raises(cxxfilt.LibraryNotFound):
+            cxxfilt.find_any_library('c')
+    finally:
+        cxxfilt._ldconfig_cache.cache_clear()
+
+
 def test_default_demangler():
     assert isinstance(cxxfilt.default_demangler, cxxfilt.Demangler)
 
     repr(cxxfilt.default_demangler)
+    weakref.ref(cxxfilt.default_demangler)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='requires PEP 562')
+def test_default_demangler_lazy():
+    subprocess.check_call([
+        sys.executable,
+        '-c',
+        'import cxxfilt\n'
+        'assert "default_demangler" not in vars(cxxfilt)\n'
+        'cxxfilt.cache_clear()\n'
+        'assert "default_demangler" not in vars(cxxfilt)\n'
+        'assert cxxfilt.demangle("_ZN3foo3barE") == "foo::bar"\n'
+        'assert isinstance(vars(cxxfilt)["default_demangler"], cxxfilt.Demangler)\n',
+    ])
 
 
 def test_ErrorDemangler():